@@ -1,168 +1,159 @@
 import streamlit as st
 import fitz  # PyMuPDF
+import io
 import re
-import pandas as pd
-from collections import defaultdict
+import sys
+import json
+import pyarrow as pa
+import ahocorasick
+from collections import Counter, defaultdict
+from pathlib import Path
+from types import MappingProxyType
 
 # === Expresiones regulares ===
-ORDER_REGEX = re.compile(r'\b(SO-|USS|SOC|AMZ)-?(\d+)\b')
+# "SO" exige guion (SO-123) y no se captura; el resto admite guion opcional (USS123, SOC-123).
+ORDER_REGEX = re.compile(r'\b(?:SO-|(USS|SOC|AMZ))-?(\d+)\b')
 SHIPMENT_REGEX = re.compile(r'\b(SH\d{5,})\b')
 PICKUP_REGEX = re.compile(r'Customer\s*Pickup|Cust\s*Pickup|CUSTPICKUP', re.IGNORECASE)
 QUANTITY_REGEX = re.compile(r'(\d+)\s*(?:EA|PCS|PC|Each)', re.IGNORECASE)
 SHIPPING_2DAY_REGEX = re.compile(r'Shipping\s*Method:\s*2\s*day', re.IGNORECASE)
+NON_SPACE_REGEX = re.compile(r'\S*')
+
+# === Texto de los PDF generados ===
+HELV_FONT = fitz.Font("helv")  # Una sola instancia reutilizada por todos los TextWriter
+TEXT_COLOR = (0, 0, 0)
+TITLE_COLOR = (0, 0, 1)
+ORDER_COLOR = (0, 0, 0.5)
+# Columnas (x, encabezado) de los listados por categoría
+LISTING_COLUMNS = ((50, "Código"), (200, "Descripción"), (450, "SH"))
 
 
 # === Funciones auxiliares ===
+def _is_word_char(char):
+    """Replica la definición de carácter de palabra (\\w) de los regex."""
+    return char.isalnum() or char == '_'
+
+def new_text_writers(page):
+    """Crea un TextWriter por color para acumular el texto de una página."""
+    return defaultdict(lambda: fitz.TextWriter(page.rect))
+
+def flush_text_writers(page, writers):
+    """Escribe en la página todo el texto acumulado, una sola vez por color."""
+    for color, writer in writers.items():
+        writer.write_text(page, color=color)
+
+def table_header_writer(columns, y, fontsize=12):
+    """
+    TextWriter con los encabezados de una tabla ya colocados; se arma una vez
+    y se escribe en cada página nueva con write_text().
+    """
+    writer = fitz.TextWriter(fitz.Rect(0, 0, 595, 842))
+    for x, header in columns:
+        writer.append((x, y), header, font=HELV_FONT, fontsize=fontsize)
+    return writer
+
 def extract_identifiers(text):
     order_match = ORDER_REGEX.search(text)
     shipment_match = SHIPMENT_REGEX.search(text)
-    order_id = f"{order_match.group(1).rstrip('-')}-{order_match.group(2)}" if order_match else None
-    shipment_id = shipment_match.group(1) if shipment_match else None
+    # Internados: todas las páginas y relaciones de una orden comparten la misma cadena
+    order_id = sys.intern(f"{order_match.group(1) or 'SO'}-{order_match.group(2)}") if order_match else None
+    shipment_id = sys.intern(shipment_match.group(1)) if shipment_match else None
     return order_id, shipment_id
 
-def extract_part_numbers(text):
+def extract_part_numbers(text_upper):
     """
-    Extrae números de parte del texto.
-    Retorna un diccionario con los números de parte encontrados como claves y valor 1.
+    Extrae números de parte del texto (ya convertido a mayúsculas).
+    Retorna un diccionario con los números de parte encontrados como claves y
+    el número de apariciones como valor.
     """
     part_counts = defaultdict(int)
-    text_upper = text.upper()
-    
-    # Obtener todas las claves de PART_DESCRIPTIONS.
-    # Las ordenamos por longitud descendente para intentar coincidir con las más largas primero,
-    # lo cual ayuda a mitigar el problema de los prefijos sin la lógica compleja de "sombreado".
-    all_part_keys_sorted = sorted(PART_DESCRIPTIONS.keys(), key=len, reverse=True)
-
-    # Creamos un conjunto para llevar un registro de las ubicaciones ya cubiertas por
-    # una coincidencia más larga.
-    matched_ranges = []
-
-    for part_key in all_part_keys_sorted:
-        # Regex más flexible:
-        # \b al inicio para asegurar que no sea parte de una palabra anterior.
-        # re.escape(part_key) para el código exacto.
-        # (?:[A-Z0-9-]*)\b: permite que el código sea seguido por guiones o caracteres alfanuméricos
-        #                 antes de un límite de palabra. Esto es para casos como "H-XXXX-YYY"
-        #                 o "H-XXXX-123".
-        #                 Si el código en el PDF NUNCA tiene nada después y es exactamente el código,
-        #                 entonces (?:[A-Z0-9-]*)\b se puede simplificar a \b.
-        #                Pero para los códigos que mencionas, que ya tienen números y guiones,
-        #                la flexibilidad es buena.
-        # Si el código SIEMPRE debe ser EXACTO sin nada pegado al final, usa r'\b' + re.escape(part_key) + r'\b'.
-        # Si puede tener un sufijo, considera esta versión o incluso r'\b' + re.escape(part_key) + r'\S*'.
-        # Para tu caso, si H-25PXG000282-OSFM no se detecta, a menudo es el \b final.
-        # Vamos a intentar un regex más flexible para el final que permita cualquier carácter no-espacio (\S*)
-        # inmediatamente después del código, y luego veremos si eso introduce falsos positivos.
-        
-        # Opción 1 (la más segura si el código es *exacto* pero \b falla por contexto):
-        # pattern = r'(?<!\w)' + re.escape(part_key) + r'(?!\w)'
-        # Este es el que ya tenías y que debería funcionar si el código es una "palabra" exacta.
-
-        # Opción 2 (más flexible al final, útil si el código es a veces seguido por algo como un sufijo o caracter no-espacio):
-        pattern = r'\b' + re.escape(part_key) + r'\S*' # \S* permite cualquier caracter no-espacio al final
 
-        # Opción 3 (si el problema es SOLO el inicio o fin y no se espera NADA después del código):
-        # pattern = r'\b' + re.escape(part_key) # Solo limite de palabra al inicio
+    # Una sola pasada del autómata Aho-Corasick encuentra todas las apariciones
+    # de todas las claves de PART_DESCRIPTIONS (en lugar de un regex por clave).
+    hits = []
+    for end_index, (key_length, key_rank, part_key) in PART_AUTOMATON.iter(text_upper):
+        start = end_index - key_length + 1
+        # Equivalente al \b inicial: el código no puede ir pegado a una palabra anterior.
+        if start > 0 and _is_word_char(text_upper[start - 1]):
+            continue
+        hits.append((-key_length, key_rank, start, part_key))
+
+    # Las coincidencias más largas tienen prioridad; a igual longitud se respeta
+    # el orden de PART_DESCRIPTIONS y luego la posición en el texto.
+    hits.sort()
+
+    # Cada coincidencia cubre desde su inicio hasta el final del "token" (\S*),
+    # de modo que un código seguido de un sufijo (p. ej. "-V2") cuenta como el código
+    # y un código más corto que empieza en el mismo lugar queda sombreado.
+    covered = bytearray(len(text_upper))
+    for neg_length, _, start, part_key in hits:
+        if covered[start]:
+            continue
+        token_end = NON_SPACE_REGEX.match(text_upper, start - neg_length).end()
+        covered[start:token_end] = b'\x01' * (token_end - start)
+        part_counts[part_key] += 1
 
-        # Para los códigos que mencionas, 'H-23PXG0000124-2-GB-OSFM' y 'H-25PXG000282-OSFM',
-        # y la dificultad de encontrarlos, la Opción 2 con `\S*` al final es la más probable
-        # para capturarlos si están pegados a algo.
-        
-        # Sin embargo, si quieres que SÓLO coincidan con el código exacto y no con variaciones como
-        # 'H-25PXG000282-OSFM-V2', entonces la opción original `(?<!\w)' + re.escape(part_key) + r'(?!\w)'`
-        # o la `\b` + re.escape(part_key) + `\b` es la correcta, y el problema es que el PDF no
-        # tiene esos códigos como "palabras completas".
+    return dict(part_counts)
 
-        # Vamos a probar con la Opción 2 para extract_part_numbers para capturar más,
-        # y luego validaremos si esto captura los códigos que buscas.
-        pattern = r'\b' + re.escape(part_key) + r'\S*'
 
+def extract_relations(part_numbers, order_id, shipment_id):
+    """
+    Construye las relaciones entre códigos, órdenes y SH a partir de los
+    números de parte ya encontrados por extract_part_numbers (sin volver a escanear el texto).
+    """
+    if not (order_id and shipment_id):
+        return []
+    return [
+        {
+            "Orden": order_id,
+            "Código": part_num,
+            "Descripción": PART_DESCRIPTIONS[part_num],
+            "SH": shipment_id
+        }
+        for part_num in part_numbers
+    ]
 
-        for match in re.finditer(pattern, text_upper):
-            start, end = match.span()
-            matched_text = match.group(0) # El texto que realmente coincidió con el patrón
-            
-            # Comprobar si esta coincidencia ya está dentro de un rango previamente cubierto
-            # por una coincidencia más larga.
-            is_shadowed = False
-            for prev_start, prev_end in matched_ranges:
-                if prev_start <= start < end <= prev_end: # Si esta coincidencia está dentro de una anterior
-                    is_shadowed = True
-                    break
-            
-            if not is_shadowed:
-                # Confirmar que el texto que coincidió es realmente uno de los códigos exactos
-                # o una variante aceptable (si la Opción 2 fue elegida).
-                # Aquí, queremos el CÓDIGO EXACTO de PART_DESCRIPTIONS.
-                if part_key == matched_text: # Si usamos \S*, es crucial que matched_text == part_key
-                                             # para que solo agreguemos el código exacto, no sus sufijos.
-                    part_counts[part_key] += 1
-                    # Añadir este rango a los rangos cubiertos.
-                    matched_ranges.append((start, end))
-                    # Ordenar los rangos cubiertos para una búsqueda eficiente en el futuro.
-                    # Esto puede ser costoso si hay muchas coincidencias, pero asegura la precisión.
-                    matched_ranges.sort()
-                elif matched_text.startswith(part_key) and part_key in PART_DESCRIPTIONS:
-                     # Si el patrón fue más flexible (como \S*), pero solo queremos contar el part_key exacto
-                     # y no la parte con el sufijo, entonces verificamos que el matched_text comience con part_key
-                     # y el part_key (sin sufijo) esté en PART_DESCRIPTIONS.
-                    part_counts[part_key] += 1
-                    matched_ranges.append((start, end))
-                    matched_ranges.sort()
-
-
-    # === BÚSQUEDA ADICIONAL PARA GUANTES QUE COMIENZAN CON G4-6520 ===
-    # Esta sección se mantiene para las reglas específicas de guantes.
-    glove_pattern = r'(G4-6520[^\s\-]*)'
-    for match in re.finditer(glove_pattern, text_upper, re.IGNORECASE):
-        full_glove_code = match.group(1)
-        if full_glove_code in PART_DESCRIPTIONS:
-            # Asegúrate de que no se superponga con una coincidencia principal ya encontrada
-            # (esto requeriría más lógica de `matched_ranges` para guantes si fueran problemáticos)
-            part_counts[full_glove_code] += 1
-            
-    return dict(part_counts)
 
+def analyze_page(page_num, text):
+    """
+    Analiza el texto de una página ya extraída.
 
-def extract_relations(text, order_id, shipment_id):
-    """Extrae relaciones entre códigos, órdenes y SH"""
-    relations = []
-    text_upper = text.upper()
-    
-    # Se utiliza la misma lógica de patrón flexible para los códigos de parte.
-    # Aquí no hay necesidad de ordenar por longitud o manejar superposiciones,
-    # ya que simplemente estamos buscando la presencia de cada código.
-    for part_num in PART_DESCRIPTIONS:
-        # Utiliza el mismo patrón flexible que en extract_part_numbers para consistencia
-        pattern = r'\b' + re.escape(part_num) + r'\S*' # \S* permite cualquier caracter no-espacio al final
-
-        # Si el código exacto aparece en el texto con o sin un sufijo no-espacio
-        if re.search(pattern, text_upper) and order_id and shipment_id:
-            # Asegúrate de que el código que se añade es el KEY exacto de PART_DESCRIPTIONS
-            relations.append({
-                "Orden": order_id,
-                "Código": part_num, # Aquí usamos el part_num exacto de la clave
-                "Descripción": PART_DESCRIPTIONS[part_num],
-                "SH": shipment_id
-            })
-
-    # Búsqueda adicional para guantes G4-6520...
-    glove_pattern = r'(G4-6520\S*)'
-    for match in re.finditer(glove_pattern, text_upper):
-        full_glove_code = match.group(1)
-        if full_glove_code in PART_DESCRIPTIONS:
-            relations.append({
-                "Orden": order_id,
-                "Código": full_glove_code,
-                "Descripción": PART_DESCRIPTIONS[full_glove_code],
-                "SH": shipment_id
-            })
-    return relations
+    No usa objetos de PyMuPDF, así que puede ejecutarse fuera del hilo que
+    lee el documento.
 
+    Returns:
+        Una tupla (page_data, relations, is_two_day).
+    """
+    text_upper = text.upper()  # Una sola conversión por página
+    order_id, shipment_id = extract_identifiers(text)
+    # Sin número de orden la página no genera relaciones ni se agrupa por orden,
+    # así que no hace falta recorrerla buscando partes.
+    part_numbers = extract_part_numbers(text_upper) if order_id else {}
+    # La búsqueda de subcadena descarta casi todas las páginas antes del regex
+    is_two_day = bool(
+        shipment_id and "METHOD:" in text_upper and SHIPPING_2DAY_REGEX.search(text)
+    )
 
+    page_data = {
+        "number": page_num,
+        "order_id": order_id,
+        "shipment_id": shipment_id,
+        "part_numbers": part_numbers,
+        # Solo se guarda si la página es de Customer Pickup: el texto completo no se conserva.
+        # Todas las variantes del regex empiezan por "Cust", así que la subcadena descarta antes.
+        "pickup": bool(order_id and "CUST" in text_upper and PICKUP_REGEX.search(text)),
+    }
+    # Relaciones de la página (reutilizando los números de parte ya encontrados)
+    relations = extract_relations(part_numbers, order_id, shipment_id)
+    return page_data, relations, is_two_day
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
 def parse_pdf(pdf_bytes):
     """
     Parses a PDF file, extracts relevant information, and returns it.
+    Results are cached by Streamlit, so reruns with the same upload skip parsing;
+    for that reason the returned data holds no fitz objects.
 
     Args:
         pdf_bytes: The content of the PDF file as bytes.
@@ -170,265 +161,101 @@ def parse_pdf(pdf_bytes):
     Returns:
         A tuple containing:
         - A list of dictionaries, where each dictionary represents a page and contains
-          the extracted information (order_id, shipment_id, part_numbers, text).
+          the extracted information (order_id, shipment_id, part_numbers, pickup).
         - A list of relations (dictionaries) between order_id, part_num, description, and shipment_id.
         - A set of shipment IDs with "2 day" shipping.
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     all_pages_data = []
     all_relations = []
     two_day_sh_list = set()
 
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text = page.get_text("text")
-        order_id, shipment_id = extract_identifiers(text)
-        part_numbers = extract_part_numbers(text)
-
-        if shipment_id and SHIPPING_2DAY_REGEX.search(text):
-            two_day_sh_list.add(shipment_id)
-
-        page_data = {
-            "number": page_num,
-            "order_id": order_id,
-            "shipment_id": shipment_id,
-            "part_numbers": part_numbers,
-            "text": text,
-            "parent": doc,  # Add the document object
-        }
-        all_pages_data.append(page_data)
-
-        # Extract relations for this page
-        if order_id and shipment_id:
-            page_relations = extract_relations(text, order_id, shipment_id)
+    # El documento se cierra al salir del bloque, aunque falle el análisis de alguna página.
+    # PyMuPDF no es thread-safe: la extracción de texto se hace en este hilo
+    # y el análisis de cada página se delega a analyze_page.
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page in doc:
+            # Extraer del TextPage directamente evita el envoltorio genérico de get_text()
+            text = page.get_textpage().extractText()
+            page_data, page_relations, is_two_day = analyze_page(page.number, text)
+            all_pages_data.append(page_data)
             all_relations.extend(page_relations)
+            if is_two_day:
+                two_day_sh_list.add(page_data["shipment_id"])
 
     return all_pages_data, all_relations, two_day_sh_list
 
-# === Definición CORRECTA y COMPLETA de partes (diccionario) ===
-PART_DESCRIPTIONS = {
-    'B-PG-081-BLK': '2023 PXG Deluxe Cart Bag - Black',
-    'B-PG-082-WHT': '2023 PXG Lightweight Cart Bag - White/Black',
-    'B-PG-172': '2025 Stars & Stripes LW Carry Stand Bag',
-    'B-PG-172-BGRY': 'Xtreme Carry Stand Bag - Black',
-    'B-PG-172-BLACK': 'Xtreme Carry Stand Bag - Freedom - Black',
-    'B-PG-172-DB': 'Deluxe Carry Stand Bag - Black',
-    'B-PG-172-DKNSS': 'Deluxe Carry Stand Bag - Darkness',
-    'B-PG-172-DW': 'Deluxe Carry Stand Bag - White',
-    'B-PG-172-GREEN': 'Xtreme Carry Stand Bag - Freedom - Green',
-    'B-PG-172-GREY': 'Xtreme Carry Stand Bag - Freedom - Grey',
-    'B-PG-172-NAVY': 'Xtreme Carry Stand Bag - Freedom - Navy',
-    'B-PG-172-TAN': 'Xtreme Carry Stand Bag - Freedom - Tan',
-    'B-PG-172-WBLK': 'Xtreme Carry Stand Bag - White',
-    'B-PG-173': '2025 Stars & Stripes Hybrid Stand Bag',
-    'B-PG-173-BGRY': 'Xtreme Hybrid Stand Bag - Black',
-    'B-PG-173-BO': 'Deluxe Hybrid Stand Bag - Black',
-    'B-PG-173-DKNSS': 'Deluxe Hybrid Stand Bag - Darkness',
-    'B-PG-173-WBLK': 'Xtreme Hybrid Stand Bag - White',
-    'B-PG-173-WO': 'Deluxe Hybrid Stand Bag - White',
-    'B-PG-244': 'Xtreme Cart Bag - White',
-    'B-PG-245': '2025 Stars & Stripes Cart Bag',
-    'B-PG-245-BLK': 'Deluxe Cart Bag B2 - Black',
-    'B-PG-245-WHT': 'Deluxe Cart Bag B2 - White',
-    'B-PG-246-POLY': 'Minimalist Carry Stand Bag - Black',
-    'B-UGB8-EP': '2020 Carry Stand Bag - Black',
-    'B-UGB14-FM': 'PXG Sunday Stand Bag - Black/White',
-    'B-UGB2-EP': '2020 Tour Bag- Black',
-    'B-UGB13-EP-B': 'Den Caddy- Black',
-
-    # --- CÓDIGOS DE LAS IMÁGENES ---
-   # image_fbd711.png (Golf Balls)
-    'GB-DOZ-XTREME': 'Xtreme Golf Ball - Dozen',
-    'GB-DOZ-XTTR-WHT': 'Xtreme Tour Golf Ball - White - Dozen',
-    'GB-DOZ-XTTR-YEL': 'Xtreme Tour Golf Ball - Yellow - Dozen',
-    'GB-DOZ-XTTRX-WHT': 'Xtreme Tour X Golf Ball - White - Dozen',
-
-    # image_fb69b2.png y image_fbd6af.png (Hats/Caps y Gloves)
-    'H-22PXG000013-BLK': 'Tall Visor - Black',
-    'H-22PXG000013-WHT': 'Tall Visor - White',
-    'H-22PXG000014-BLK': 'Sport Visor - Black',
-    'H-22PXG000014-WHT': 'Sport Visor - White',
-    'H-23PXG0000124-2-GB-OSFM': 'Dog Tag 6-Panel Snapback Cap - Grey/Black Logo - One Size',
-    'H-23PXG0000124-2-BG-OSFM': 'Dog Tag 6-Panel Snapback Cap - Black/Grey Logo - One Size',
-    'H-23PXG0000124-2-BW-OSFM': 'Dog Tag 6-Panel Snapback Cap - Black/White Logo - One Size',
-    'H-23PXG0000124-2-CG-OSFM': 'Dog Tag 6-Panel Snapback Cap - White/Grey Logo - One Size',
-    'H-23PXG0000124-2-WG-OSFM': 'Dog Tag 6-Panel Snapback Cap - White/Grey Logo - One Size', # Duplicado, mantener si es diferente
-    'H-23PXG000078-1-S-M': 'Tour Bush Hat - White - S/M',
-    'H-23PXG000094-1-OSFM-BLK': 'Faceted Front Trucker Cap - Black - One Size',
-    'H-23PXG000094-1-OSFM-WHT': 'Faceted Front Trucker Cap - White - One Size',
-    'H-23PXG000101-BW-OSFM': 'Men\'s 6-Panel High Crown Snapback Cap - Black/White Logo - One Size',
-    'H-23PXG000101-NW-OSFM': 'Men\'s 6-Panel High Crown Snapback Cap - Navy/White Logo - One Size',
-    'H-23PXG000101-WB-OSFM': 'Men\'s 6-Panel High Crown Snapback Cap - White/Black Logo - One Size',
-    'H-23PXG000101-WG-OSFM': 'Men\'s 6-Panel High Crown Snapback Cap - White/Grey Logo - One Size',
-    'H-23PXG000123-BG-OSFM': 'Men\'s Dog Tag 6-Panel High Crown Snapback Cap - Black/Grey Logo - One Size',
-    'H-23PXG000123-BW-OSFM': 'Men\'s Dog Tag 6-Panel High Crown Snapback Cap - Black/White Logo - One Size',
-    'H-23PXG000123-GB-OSFM': 'Men\'s Dog Tag 6-Panel High Crown Snapback Cap - Grey/Black Logo - One Size',
-    'H-23PXG000123-WG-OSFM': 'Men\'s Dog Tag 6-Panel High Crown Snapback Cap - White/Grey Logo - One Size',
-    'H-23PXG000125-WN-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - White/Navy Logo - One Size',
-    'H-23PXG000125-BG-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - Black/Grey Logo - One Size',
-    'H-23PXG000125-BW-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - Black/White Logo - One Size',
-    'H-23PXG000125-GB-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - Grey/Black Logo - One Size',
-    'H-23PXG000125-NW-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - Navy/White Logo - One Size',
-    'H-23PXG000125-WG-OSFM': 'Men\'s Dog Tag 5-Panel Snapback Cap - White/Grey Logo - One Size',
-    'H-23PXG000126-WN-OSFM': 'Stretch Snapback Hat - White - One Size', # Este es de image_fbd6af.png, lo he ajustado
-    'H-23PXG000166-BLK-OSFM': 'Stretch Snapback Hat - Black - One Size',
-    'H-23PXG000166-WHT-OSFM': 'Stretch Snapback Hat - White - One Size',
-    'H-23PXG000167-WB-OSFM': 'Scottsdale Trucker Snapback Hat - White/Blue Logo - One Size',
-    'H-23PXG000167-BW-OSFM': 'Scottsdale Trucker Snapback Hat - Black/White Logo - One Size',
-    'H-23PXG000167-GB-OSFM': 'Scottsdale Trucker Snapback Hat - Grey/Black Logo - One Size',
-    'H-23PXG000167-WHT-OSFM': 'Scottsdale Trucker Snapback Hat - White - One Size',
-    'H-23PXG000167-WW-OSFM': 'Scottsdale Trucker Snapback Hat - White/White Logo - One Size',
-    'H-23PXG000168-BLK-OSFM': 'Stretch Patch Snapback Hat - Black - One Size',
-    'H-23PXG000168-GRY-OSFM': 'Stretch Patch Snapback Hat - Grey - One Size',
-    'H-23PXG000168-NVY-OSFM': 'Stretch Patch Snapback Hat - Navy - One Size',
-    'H-23PXG000168-WHT-OSFM': 'Stretch Patch Snapback Hat - White - One Size',
-    'H-24PXG000203-2-BLK-OSFM': 'Women\'s Metallic Minimalist - Unstructured Hat - Black - One Size',
-    'H-24PXG000203-2-WHT-OSFM': 'Women\'s Metallic Minimalist - Unstructured Hat - White - One Size',
-    'H-24PXG000214-1-BLK-OSFM': 'Camper Flat Bill Snapback Cap - Black - One Size',
-    'H-24PXG000214-1-WHT-OSFM': 'Camper Flat Bill Snapback Cap - White - One Size',
-    'H-24PXG000218-1-OSFM': '6 Panel Structured Low Crown Snapback Cap - Black - One Size',
-    'H-24PXG000219-OSFM': 'Women\'s Metallic Minimalist - Unstructured Hat - Grey - One Size',
-    'H-24PXG000229-OSFM': 'US Navy Structured Hat Snapback - One Size',
-    'H-24PXG000235-BW-OSFM': 'Dog Tag 6-Panel Low Crown Snapback - Black/White Logo - One Size',
-    'H-24PXG000235-GB-OSFM': 'Dog Tag 6-Panel Low Crown Snapback - Grey/Black Logo - One Size',
-    'H-24PXG000235-WG-OSFM': 'Dog Tag 6-Panel Low Crown Snapback - White/Grey Logo - One Size',
-    'H-24PXG000239-OSFM': 'Women\'s Metallic Minimalist - Unstructured Hat - Light Blue - One Size',
-    'H-24PXG000276-OSFM': '2025 Stars & Stripes Low Crown Cap - One Size',
-    'H-24PXG000277-OSFM': '2025 Stars & Stripes Dog Tag Cap - One Size',
-    'H-24PXG000278-OSFM': '2025 Stars & Stripes High Crown Cap - One Size',
-    'H-25PXG000282-OSFM': '2025 Stars & Stripes Trucker Cap - One Size',
-    'H-24PXG000282-OSFM': '2025 Stars & Stripes Trucker Cap - One Size',
-    'H-25PXG000283-OSFM': '2025 Stars & Stripes Dog Tag Trucker - One Size',
-    'H-USMC-ADJ': 'PXG USMC Unstructured Hat - Adjustable',
-
-    # image_fbd658.png (Accessories)
-    'A-UAC18-FM': 'PXG Wedge Brush - Chrome',
-    'A-UAC17-FM': 'PXG Wedge Brush - Black',
-    'A-ALIGNSTICKS-WHT': 'PXG Player Alignment Sticks - White',
-    'A-NX10SLOPE-PXG': 'PXG NX10 Rangefinder Slope Edition - White',
-    'A-UAC28-FM': 'PXG Milled Divot Tool (Weighted)',
-    'A-IHC62918PXG-COP': 'PXG Magnetic Ball Marker & Cap Clip - Rose Gold',
-    'A-IHC62920PXG-BLK': 'PXG Magnetic Ball Marker & Cap Clip - Black',
-    'A-DUO-PXG': 'PXG Golf Speaker - White',
-    'A-ICU55715PXG-ALS': 'PXG Deluxe Alignment Stick Cover',
-    'A-DARKNESS-COASTER': 'PXG Darkness Coaster',
-    'HC-JT-1053-KIT': 'PXG 2022 Iron Cover Kit',
-    'A-UAC29-FM': 'PXG (DRKNSS) Divot Tool',
-    'A-Q25240-ASM': 'Milled Starburst Ball Marker',
-    'A-ZNP53374-1': 'Darkness Leather Wrapped Divot Tool',
-    'A-JT-4697': 'Darkness Alignment Stick Cover - Black',
-    'A-1IBM65819PXGCAT': 'Copper Cactus Ball Marker',
-    'A-Q23192-ASM-2': 'Chrome Logo Ball Marker',
-    'A-Q25645-ASM-1': '2025 Stars & Stripes Ball Marker',
-    'A-1IBM65820PXG-DT': '2023 Darkness Dog Tag Ball Marker',
-
-   # Guantes adicionales (de image_fbd6af.png, sección de abajo)
-'G4-652011019LHL-BLK': 'Men\'s LH Players Glove - Black L',
-'G4-652011019LHLC-BLK': 'Men\'s LH Players Glove - Cadet Black L',
-'G4-652011019LHLW-BLK': 'Men\'s LH Players Glove - White L',
-'G4-652011019LHM-BLK': 'Men\'s LH Players Glove - Black M',
-'G4-652011019LHMC-BLK': 'Men\'s LH Players Glove - Cadet Black M',
-'G4-652011019LHML-BLK': 'Men\'s LH Players Glove - Black ML',
-'G4-652011019LHMLC-BLK': 'Men\'s LH Players Glove - Cadet Black ML',
-'G4-652011019LHMW-BLK': 'Women\'s LH Players Glove - Black M',
-'G4-652011019LHS-BLK': 'Men\'s LH Players Glove - Black S',
-'G4-652011019LHSC-BLK': 'Men\'s LH Players Glove - Cadet Black S',
-'G4-652011019LHSW-BLK': 'Men\'s LH Players Glove - White S',
-'G4-652011019LHXL-BLK': 'Men\'s LH Players Glove - Black XL',
-'G4-652011019LHXLC-BLK': 'Men\'s LH Players Glove - Cadet Black XL',
-'G4-652011019RHL-BLK': 'Men\'s RH Players Glove - Black L',
-'G4-652011019RHLC-BLK': 'Men\'s RH Players Glove - Cadet Black L',
-'G4-652011019RHM-BLK': 'Men\'s RH Players Glove - Black M',
-'G4-652011019RHMC-BLK': 'Men\'s RH Players Glove - Cadet Black M',
-'G4-652011019RHML-BLK': 'Men\'s RH Players Glove - Black ML',
-'G4-652011019RHMLC-BLK': 'Men\'s RH Players Glove - Cadet Black ML',
-'G4-652011019RHS-BLK': 'Men\'s RH Players Glove - Black S',
-'G4-652011019RHSC-BLK': 'Men\'s RH Players Glove - Cadet Black S',
-'G4-652011019RHXL-BLK': 'Men\'s RH Players Glove - Black XL',
-'G4-652011019RHXLC-BLK': 'Men\'s RH Players Glove - Cadet Black XL',
-'G4-652011019RHXXL-BLK': 'Men\'s RH Players Glove - Black XXL',
-'G4-652021019LHL-WHT': 'Men\'s LH Players Glove - White L',
-'G4-652021019LHLC-WHT': 'Men\'s LH Players Glove - Cadet White L',
-'G4-652021019LHLW-WHT': 'Men\'s LH Players Glove - White L',
-'G4-652021019LHM-WHT': 'Men\'s LH Players Glove - White M',
-'G4-652021019LHMC-WHT': 'Men\'s LH Players Glove - Cadet White M',
-'G4-652021019LHML-WHT': 'Men\'s LH Players Glove - White ML',
-'G4-652021019LHMLC-WHT': 'Men\'s LH Players Glove - Cadet White ML',
-'G4-652021019LHMW-WHT': 'Women\'s LH Players Glove - White M',
-'G4-652021019LHS-WHT': 'Men\'s LH Players Glove - White S',
-'G4-652021019LHSC-WHT': 'Men\'s LH Players Glove - Cadet White S',
-'G4-652021019LHSW-WHT': 'Men\'s LH Players Glove - White S',
-'G4-652021019LHXL-WHT': 'Men\'s LH Players Glove - White XL',
-'G4-652021019LHXLC-WHT': 'Men\'s LH Players Glove - Cadet White XL',
-'G4-652021019LHXXL-WHT': 'Men\'s LH Players Glove - White XXL',
-'G4-652021019RHL-WHT': 'Men\'s RH Players Glove - White L',
-'G4-652021019RHLC-WHT': 'Men\'s RH Players Glove - Cadet White L',
-'G4-652021019RHLW-WHT': 'Men\'s RH Players Glove - White L',
-'G4-652021019RHM-WHT': 'Men\'s RH Players Glove - White M',
-'G4-652021019RHMC-WHT': 'Men\'s RH Players Glove - Cadet White M',
-'G4-652021019RHML-WHT': 'Men\'s RH Players Glove - White ML',
-'G4-652021019RHMLC-WHT': 'Men\'s RH Players Glove - Cadet White ML',
-'G4-652021019RHMW-WHT': 'Women\'s RH Players Glove - White M',
-'G4-652021019RHS-WHT': 'Men\'s RH Players Glove - White S',
-'G4-652021019RHSC-WHT': 'Men\'s RH Players Glove - Cadet White S',
-'G4-652021019RHSW-WHT': 'Men\'s RH Players Glove - White S',
-'G4-652021019RHXL-WHT': 'Men\'s RH Players Glove - White XL',
-'G4-652021019RHXLC-WHT': 'Men\'s RH Players Glove - Cadet White XL',
-'G4-652021019RHXXL-WHT': 'Men\'s RH Players Glove - White XXL',
-}
-
-def create_relations_table(relations):
+# === Definición CORRECTA y COMPLETA de partes (parts.json) ===
+PARTS_FILE = Path(__file__).with_name("parts.json")
+
+@st.cache_resource(show_spinner=False)
+def load_part_descriptions():
     """
-    Crea una tabla PDF con cada código en una línea separada,
-    excluyendo pelotas, gorras y accesorios de la lista principal.
+    Carga el catálogo de partes una sola vez por proceso (se conserva el orden del archivo).
+    Es de solo lectura: cache_resource comparte el mismo objeto entre reruns y sesiones.
     """
-    if not relations:
-        return None
-    
-    # Filtrar las relaciones para incluir solo los ítems clasificados como "Otros".
-    # Esto elimina pelotas, gorras y accesorios de esta tabla.
-    filtered_relations = [
-        rel for rel in relations
-        if classify_item(rel["Código"], rel["Descripción"]) == "Otros"
-    ]
+    with PARTS_FILE.open(encoding="utf-8") as parts_file:
+        return MappingProxyType(json.load(parts_file))
+
+@st.cache_resource(show_spinner=False)
+def build_part_automaton():
+    """
+    Autómata Aho-Corasick con todas las claves de PART_DESCRIPTIONS.
+    Cada valor guarda (longitud, posición en el diccionario, código).
+    """
+    automaton = ahocorasick.Automaton()
+    for rank, part_key in enumerate(load_part_descriptions()):
+        automaton.add_word(part_key, (len(part_key), rank, part_key))
+    automaton.make_automaton()
+    return automaton
+
+PART_DESCRIPTIONS = load_part_descriptions()
+PART_AUTOMATON = build_part_automaton()
 
+def create_relations_table(filtered_relations, target_doc=None):
+    """
+    Crea una tabla PDF con cada código en una línea separada.
+    Recibe solo las relaciones de la categoría "Otros", de modo que pelotas,
+    gorras y accesorios quedan fuera de la lista principal.
+    """
     if not filtered_relations:
         st.info("No se encontraron relaciones de 'Otros' productos para mostrar en la tabla principal.")
         return None
         
-    df = pd.DataFrame(filtered_relations)
-    
     # Ordenar para una mejor visualización, por Orden, luego por Código.
-    df = df.sort_values(by=['Orden', 'Código']).reset_index(drop=True)
+    # Las relaciones ya llegan ordenadas por Código: al ser estable, basta ordenar por Orden.
+    rows = sorted(filtered_relations, key=lambda rel: rel['Orden'])
     
-    doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page(width=595, height=842)
+    writers = new_text_writers(page)
     y = 50
     
     # Título para la tabla, indicando la exclusión.
     title = "RELACIÓN ÓRDENES - CÓDIGOS - SH (Excluyendo Pelotas, Gorras y Accesorios)"
-    page.insert_text((50, y), title, fontsize=16, color=(0, 0, 1), fontname="helv")
+    writers[TITLE_COLOR].append((50, y), title, font=HELV_FONT, fontsize=16)
     y += 30
     
     # Encabezados de la tabla.
     headers = ["Orden", "Código", "Descripción", "SH"]
-    page.insert_text((50, y), headers[0], fontsize=12, fontname="helv")
-    page.insert_text((150, y), headers[1], fontsize=12, fontname="helv")
-    page.insert_text((300, y), headers[2], fontsize=12, fontname="helv")
-    page.insert_text((500, y), headers[3], fontsize=12, fontname="helv")
+    writers[TEXT_COLOR].append((50, y), headers[0], font=HELV_FONT, fontsize=12)
+    writers[TEXT_COLOR].append((150, y), headers[1], font=HELV_FONT, fontsize=12)
+    writers[TEXT_COLOR].append((300, y), headers[2], font=HELV_FONT, fontsize=12)
+    writers[TEXT_COLOR].append((500, y), headers[3], font=HELV_FONT, fontsize=12)
     y += 20
     
     current_order = None # Variable para detectar cambios de orden y agregar espaciado.
     
-    for _, row in df.iterrows():
+    for row in rows:
         # Si la página está llena, crea una nueva página y reinserta los encabezados.
         if y > 750:
+            flush_text_writers(page, writers)
             page = doc.new_page(width=595, height=842)
+            writers = new_text_writers(page)
             y = 50
-            page.insert_text((50, y), headers[0], fontsize=12, fontname="helv")
-            page.insert_text((150, y), headers[1], fontsize=12, fontname="helv")
-            page.insert_text((300, y), headers[2], fontsize=12, fontname="helv")
-            page.insert_text((500, y), headers[3], fontsize=12, fontname="helv")
+            writers[TEXT_COLOR].append((50, y), headers[0], font=HELV_FONT, fontsize=12)
+            writers[TEXT_COLOR].append((150, y), headers[1], font=HELV_FONT, fontsize=12)
+            writers[TEXT_COLOR].append((300, y), headers[2], font=HELV_FONT, fontsize=12)
+            writers[TEXT_COLOR].append((500, y), headers[3], font=HELV_FONT, fontsize=12)
             y += 20
             
         order = row['Orden']
@@ -437,45 +264,50 @@ def create_relations_table(relations):
         if order != current_order:
             if current_order is not None: # Agrega un espacio extra si no es la primera orden.
                 y += 10
-            page.insert_text((50, y), order, fontsize=10, fontname="helv", color=(0,0,0.5)) # Orden en color diferente.
+            writers[ORDER_COLOR].append((50, y), order, font=HELV_FONT, fontsize=10) # Orden en color diferente.
             current_order = order
             y += 5 # Pequeño espacio después de la orden.
 
         # Inserta el código, descripción y SH en la misma línea.
-        page.insert_text((150, y), row['Código'], fontsize=10)
-        page.insert_text((300, y), row['Descripción'], fontsize=10)
-        page.insert_text((500, y), row['SH'], fontsize=10)
+        writers[TEXT_COLOR].append((150, y), row['Código'], font=HELV_FONT, fontsize=10)
+        writers[TEXT_COLOR].append((300, y), row['Descripción'], font=HELV_FONT, fontsize=10)
+        writers[TEXT_COLOR].append((500, y), row['SH'], font=HELV_FONT, fontsize=10)
         
         y += 15 # Espacio para la siguiente línea.
             
+    flush_text_writers(page, writers)
     return doc
 
 # === Nueva función para crear página de SH 2 day ===
-def create_2day_shipping_page(two_day_sh_list):
-    """Crea una página con la lista de SH con método 2 day"""
+def create_2day_shipping_page(two_day_sh_list, target_doc=None):
+    """Crea una página con la lista de SH con método 2 day (ya ordenada)"""
     if not two_day_sh_list:
         return None
     
-    doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page(width=595, height=842)
+    writers = new_text_writers(page)
     y = 72
     
     # Título
-    page.insert_text((72, y), "ÓRDENES CON SHIPPING METHOD: 2 DAY",
-                     fontsize=16, color=(0, 0, 1), fontname="helv")
+    writers[TITLE_COLOR].append((72, y), "ÓRDENES CON SHIPPING METHOD: 2 DAY",
+                                font=HELV_FONT, fontsize=16)
     y += 30
     
     # Lista de SH
-    for sh in sorted(two_day_sh_list):
+    for sh in two_day_sh_list:
         if y > 750:
+            flush_text_writers(page, writers)
             page = doc.new_page(width=595, height=842)
+            writers = new_text_writers(page)
             y = 72
-        page.insert_text((72, y), sh, fontsize=12)
+        writers[TEXT_COLOR].append((72, y), sh, font=HELV_FONT, fontsize=12)
         y += 20
     
-    page.insert_text((72, y + 20), f"Total de órdenes 2 day: {len(two_day_sh_list)}",
-                     fontsize=14, color=(0, 0, 1))
+    writers[TITLE_COLOR].append((72, y + 20), f"Total de órdenes 2 day: {len(two_day_sh_list)}",
+                                font=HELV_FONT, fontsize=14)
     
+    flush_text_writers(page, writers)
     return doc
 
 def display_interactive_table(relations):
@@ -486,28 +318,46 @@ def display_interactive_table(relations):
         st.info("No se encontraron relaciones para mostrar en la tabla interactiva.")
         return
 
-    df = pd.DataFrame(relations)
-
     st.subheader("Tabla Interactiva de Relaciones (Órdenes, Códigos, SH)")
     
-    # Using st.dataframe for a simple interactive table
-    st.dataframe(df)
+    # Arrow es el formato nativo de st.dataframe: se evita la conversión desde pandas
+    st.dataframe(pa.Table.from_pylist(relations))
 
-def filter_relations_by_category(relations, category):
-    """Filtra las relaciones por categoría."""
-    return [rel for rel in relations if classify_item(rel["Código"], rel["Descripción"]) == category]
+def unique_relations(relations):
+    """
+    Elimina relaciones repetidas (misma Orden, Código y SH), conservando la
+    primera aparición. Un mismo código suele repetirse en varias páginas de la
+    orden y en ambos PDFs.
+    """
+    seen = set()
+    unique = []
+    for rel in relations:
+        key = (rel["Orden"], rel["Código"], rel["SH"])
+        if key not in seen:
+            seen.add(key)
+            unique.append(rel)
+    return unique
+
+def group_relations_by_category(relations):
+    """Agrupa las relaciones por categoría en una sola pasada."""
+    relations_by_category = defaultdict(list)
+    for rel in relations:
+        relations_by_category[PART_CATEGORY[rel["Código"]]].append(rel)
+    return relations_by_category
 
-def display_category_table(relations, category):
-    """Muestra una tabla interactiva para una categoría específica."""
-    filtered_relations = filter_relations_by_category(relations, category)
+def display_category_table(filtered_relations, category):
+    """Muestra una tabla interactiva con las relaciones de una categoría específica."""
     if filtered_relations:
         st.subheader(f"Tabla Interactiva de {category}")
-        df = pd.DataFrame(filtered_relations)
-        st.dataframe(df)
+        st.dataframe(pa.Table.from_pylist(filtered_relations))
     else:
         st.info(f"No se encontraron relaciones de {category} para mostrar.")
 
-def create_summary_page(order_data, build_keys, shipment_keys, pickup_flag):
+def create_summary_page(order_data, build_keys, shipment_keys, pickup_flag, target_doc=None, pno=-1):
+    """
+    Crea la página de resumen de órdenes. Con `pno` se inserta delante de esa
+    página de `target_doc` (por ejemplo, pno=0 para ponerla al inicio).
+    """
     all_orders = set(build_keys) | set(shipment_keys)
     unmatched_build = set(build_keys) - set(shipment_keys)
     unmatched_ship = set(shipment_keys) - set(build_keys)
@@ -524,16 +374,18 @@ def create_summary_page(order_data, build_keys, shipment_keys, pickup_flag):
     if pickup_flag:
         lines.append(f"Customer Pickup Orders: {len(pickup_orders)}")
 
-    summary_doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     y = 72
-    page = summary_doc.new_page(width=595, height=842)
+    page = doc.new_page(pno=pno, width=595, height=842)
     for line in lines:
         if y > 770:
-            page = summary_doc.new_page(width=595, height=842)
+            if pno >= 0:
+                pno += 1  # La página siguiente va detrás de la recién insertada
+            page = doc.new_page(pno=pno, width=595, height=842)
             y = 72
         page.insert_text((72, y), line, fontsize=12)
         y += 14
-    return summary_doc
+    return doc
 
 
 def get_build_order_list(build_pages):
@@ -547,42 +399,53 @@ def get_build_order_list(build_pages):
     return order
 
 
+def _new_order():
+    """Estado inicial de una orden en group_by_order."""
+    return {"pages": [], "pickup": False, "part_numbers": Counter()}
+
 def group_by_order(pages, classify_pickup=False):
-    order_map = defaultdict(lambda: {"pages": [], "pickup": False, "part_numbers": defaultdict(int)})
+    order_map = {}
     for page in pages:
         oid = page.get("order_id")  # Usa .get() para evitar KeyError
         if not oid:
             continue
-        order_map[oid]["pages"].append(page)
-        if classify_pickup:
-            text = page.get("text", "")
-            if PICKUP_REGEX.search(text):
-                order_map[oid]["pickup"] = True
-        for part_num, qty in page.get("part_numbers", {}).items():
-            order_map[oid]["part_numbers"][part_num] += qty
+        order = order_map.get(oid)
+        if order is None:
+            order = order_map[oid] = _new_order()
+        order["pages"].append(page)
+        if classify_pickup and page.get("pickup"):
+            order["pickup"] = True
+        # Counter.update suma las cantidades de la página en C
+        order["part_numbers"].update(page.get("part_numbers", {}))
     return order_map
 
 
-def create_part_numbers_summary(order_data, category_filter=None): # ADDED category_filter=None
+def summarize_part_appearances(order_data):
     """
-    Crea una tabla PDF con el resumen de apariciones de números de parte,
-    opcionalmente filtrado por categoría.
+    Suma en una sola pasada las apariciones de cada número de parte en todas
+    las órdenes y las agrupa por categoría.
     """
-    part_appearances = defaultdict(int)
+    total_appearances = Counter()
+    for data in order_data.values():
+        total_appearances.update(data.get("part_numbers", {}))
 
-    for oid, data in order_data.items():
-        part_numbers = data.get("part_numbers", {})
-        for part_num, count in part_numbers.items():
-            if part_num in PART_DESCRIPTIONS:
-                # Aplicar el filtro de categoría si se proporciona
-                if category_filter is None or classify_item(part_num, PART_DESCRIPTIONS[part_num]) == category_filter:
-                    part_appearances[part_num] += count
+    appearances_by_category = defaultdict(Counter)
+    for part_num, count in total_appearances.items():
+        appearances_by_category[PART_CATEGORY[part_num]][part_num] = count
+    return appearances_by_category
 
+
+def create_part_numbers_summary(part_appearances, category_filter=None, target_doc=None):
+    """
+    Crea una tabla PDF con el resumen de apariciones de números de parte
+    ya agregadas (ver summarize_part_appearances) para una categoría.
+    """
     if not part_appearances:
         return None
 
-    doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page(width=595, height=842)
+    writers = new_text_writers(page)
 
     y_coordinate = 72
     left_margin_code = 50
@@ -591,13 +454,19 @@ def create_part_numbers_summary(order_data, category_filter=None): # ADDED categ
 
     # Título dinámico basado en el filtro de categoría
     # Changed title to reflect the category filter
-    summary_title = f"RESUMEN DE APARICIONES DE PARTES: {category_filter.upper() if category_filter else 'GENERAL'}"
-    page.insert_text((left_margin_code, y_coordinate - 30), summary_title, fontsize=16, color=(0, 0, 1))
+    summary_title = f"RESUMEN DE APARICIONES DE PARTES: {CATEGORY_LABELS[category_filter] if category_filter else 'GENERAL'}"
+    title_writer = fitz.TextWriter(page.rect)
+    title_writer.append((left_margin_code, y_coordinate - 30), summary_title, font=HELV_FONT, fontsize=16)
+
+    header_columns = ((left_margin_code, "Código"), (left_margin_desc, "Descripción"), (left_margin_count, "Apariciones"))
+    header_writer = table_header_writer(header_columns, y_coordinate)
 
-    headers = ["Código", "Descripción", "Apariciones"]
-    page.insert_text((left_margin_code, y_coordinate), headers[0], fontsize=12)
-    page.insert_text((left_margin_desc, y_coordinate), headers[1], fontsize=12)
-    page.insert_text((left_margin_count, y_coordinate), headers[2], fontsize=12)
+    def _draw_header(page):
+        # Título y encabezados se arman una vez y se escriben igual en cada página
+        title_writer.write_text(page, color=TITLE_COLOR)
+        header_writer.write_text(page, color=TEXT_COLOR)
+
+    _draw_header(page)
     y_coordinate += 25
 
     # Ordenar las partes alfabéticamente
@@ -608,50 +477,52 @@ def create_part_numbers_summary(order_data, category_filter=None): # ADDED categ
             continue
 
         if y_coordinate > 750:
+            flush_text_writers(page, writers)
             page = doc.new_page(width=595, height=842)
+            writers = new_text_writers(page)
             y_coordinate = 72
             # Re-insert title and headers on new page
-            page.insert_text((left_margin_code, y_coordinate - 30), summary_title, fontsize=16, color=(0, 0, 1))
-            page.insert_text((left_margin_code, y_coordinate), headers[0], fontsize=12)
-            page.insert_text((left_margin_desc, y_coordinate), headers[1], fontsize=12)
-            page.insert_text((left_margin_count, y_coordinate), headers[2], fontsize=12)
+            _draw_header(page)
             y_coordinate += 25
 
         description = PART_DESCRIPTIONS[part_num]
 
-        page.insert_text((left_margin_code, y_coordinate), part_num, fontsize=10)
+        writers[TEXT_COLOR].append((left_margin_code, y_coordinate), part_num, font=HELV_FONT, fontsize=10)
 
         # Manejo de descripciones largas
         if len(description) > 40:
-            page.insert_text((left_margin_desc, y_coordinate), description[:40], fontsize=9)
-            page.insert_text((left_margin_desc, y_coordinate + 12), description[40:], fontsize=9)
+            writers[TEXT_COLOR].append((left_margin_desc, y_coordinate), description[:40], font=HELV_FONT, fontsize=9)
+            writers[TEXT_COLOR].append((left_margin_desc, y_coordinate + 12), description[40:], font=HELV_FONT, fontsize=9)
             line_height = 25
         else:
-            page.insert_text((left_margin_desc, y_coordinate), description, fontsize=10)
+            writers[TEXT_COLOR].append((left_margin_desc, y_coordinate), description, font=HELV_FONT, fontsize=10)
             line_height = 15
 
-        page.insert_text((left_margin_count, y_coordinate), str(count), fontsize=10)
+        writers[TEXT_COLOR].append((left_margin_count, y_coordinate), str(count), font=HELV_FONT, fontsize=10)
         y_coordinate += line_height
 
     total_appearances = sum(part_appearances.values())
     y_coordinate += 20
 
     if y_coordinate > 780:
+        flush_text_writers(page, writers)
         page = doc.new_page(width=595, height=842)
+        writers = new_text_writers(page)
         y_coordinate = 72
 
     # Changed total appearances label
-    page.insert_text(
+    writers[TITLE_COLOR].append(
         (left_margin_code, y_coordinate),
         f"TOTAL DE APARICIONES ({category_filter if category_filter else 'GENERAL'}): {total_appearances}",
-        fontsize=14,
-        color=(0, 0, 1)
+        font=HELV_FONT,
+        fontsize=14
     )
 
+    flush_text_writers(page, writers)
     return doc
-def insert_divider_page(doc, label):
-    """Crea una página divisoria con texto de etiqueta"""
-    page = doc.new_page()
+def insert_divider_page(doc, label, pno=-1):
+    """Crea una página divisoria con texto de etiqueta (por defecto al final del documento)"""
+    page = doc.new_page(pno=pno)
     text = f"=== {label.upper()} ==="
     page.insert_text(
         point=(72, 72),
@@ -663,111 +534,107 @@ def insert_divider_page(doc, label):
 
 # --- NUEVAS FUNCIONES PARA CLASIFICAR Y GENERAR PDFs POR CATEGORÍA ---
 
+# Reglas de clasificación en orden de prioridad:
+# (categoría, prefijos del código, palabras clave de la descripción).
+CATEGORY_RULES = (
+    ("Pelotas", ('GB-DOZ-',), ("GOLF BALL",)),
+    ("Gorras", ('H-',), ("HAT", "CAP")),
+    ("Guantes", ('G4-',), ()),
+    ("Accesorios", ('A-', 'HC-'), ()),
+)
+
 def classify_item(item_code, item_description):
     item_code_upper = item_code.upper()
     item_description_upper = item_description.upper()
 
-    if item_code_upper.startswith('GB-DOZ-') or "GOLF BALL" in item_description_upper:
-        return "Pelotas"
-    elif item_code_upper.startswith('H-') or ("HAT" in item_description_upper or "CAP" in item_description_upper):
-        return "Gorras"
-    elif item_code_upper.startswith('G4-'):
-        return "Guantes"
-    elif item_code_upper.startswith(('A-', 'HC-')):
-        return "Accesorios"
+    for category, code_prefixes, description_keywords in CATEGORY_RULES:
+        if item_code_upper.startswith(code_prefixes) or any(
+            keyword in item_description_upper for keyword in description_keywords
+        ):
+            return category
     return "Otros"
 
+# La categoría de cada código es fija: se calcula una sola vez al cargar el módulo.
+PART_CATEGORY = MappingProxyType({code: classify_item(code, desc) for code, desc in PART_DESCRIPTIONS.items()})
+
+# Nombres de categoría en mayúsculas para los títulos de los PDF.
+CATEGORY_LABELS = MappingProxyType(
+    {**{category: category.upper() for category, _, _ in CATEGORY_RULES}, "Otros": "OTROS"}
+)
+
 
-def create_category_table(relations, category_name):
+def create_category_table(category_relations, category_name, target_doc=None):
     """
     Crea una tabla PDF con un listado de códigos, descripciones y SH para una categoría específica.
+    Recibe únicamente las relaciones que pertenecen a esa categoría, ya ordenadas por código.
     """
-    unique_items_in_category = {} # Usaremos un diccionario para guardar el primer SH encontrado
-    category_data = []
+    # Un diccionario por código guarda la fila completa con el primer SH encontrado,
+    # así no hace falta reconstruir las filas en un segundo recorrido.
+    unique_items_in_category = {}
+    for rel in category_relations:
+        item_code = rel["Código"]
+        if item_code not in unique_items_in_category:
+            unique_items_in_category[item_code] = {
+                "Código": item_code,
+                "Descripción": rel["Descripción"],
+                "SH": rel["SH"]
+            }
 
-    for rel in relations:
-        if classify_item(rel["Código"], rel["Descripción"]) == category_name:
-            item_code = rel["Código"]
-            item_description = rel["Descripción"]
-            item_sh = rel["SH"] # Capturamos el SH
-
-            # Si el código ya se ha añadido, no lo volvemos a añadir a unique_items_in_category
-            # pero sí podemos actualizar el SH si queremos el último o el primero.
-            # Por simplicidad, tomaremos el primer SH que encontremos para cada código.
-            if item_code not in unique_items_in_category:
-                unique_items_in_category[item_code] = {
-                    "Descripción": item_description,
-                    "SH": item_sh # Guardamos el SH asociado
-                }
-
-    # Construir category_data a partir del diccionario unique_items_in_category
-    for code, details in unique_items_in_category.items():
-        category_data.append({
-            "Código": code,
-            "Descripción": details["Descripción"],
-            "SH": details["SH"] # Agregamos el SH aquí
-        })
+    category_data = list(unique_items_in_category.values())
 
     if not category_data:
         return None
 
-    doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page(width=595, height=842)
+    writers = new_text_writers(page)
     y = 50
 
     # Título de la categoría
-    page.insert_text((50, y), f"LISTADO DE {category_name.upper()}",
-                     fontsize=16, color=(0, 0, 1), fontname="helv")
+    writers[TITLE_COLOR].append((50, y), f"LISTADO DE {CATEGORY_LABELS[category_name]}", font=HELV_FONT, fontsize=16)
     y += 30
 
     # Encabezados - ¡Aquí es donde agregamos 'SH'!
-    headers = ["Código", "Descripción", "SH"]
-    page.insert_text((50, y), headers[0], fontsize=12, fontname="helv")
-    page.insert_text((200, y), headers[1], fontsize=12, fontname="helv")
-    page.insert_text((450, y), headers[2], fontsize=12, fontname="helv") # Ajustar posición para SH
+    table_header_writer(LISTING_COLUMNS, y).write_text(page, color=TEXT_COLOR)
     y += 20
+    # Los encabezados de las páginas siguientes se arman una sola vez
+    continuation_header = table_header_writer(LISTING_COLUMNS, 50)
 
-    # Convertir a DataFrame para ordenar por Código
-    df_category = pd.DataFrame(category_data).sort_values(by=["Código"])
-
-    for _, row in df_category.iterrows():
+    for row in category_data:
         if y > 750:
+            flush_text_writers(page, writers)
             page = doc.new_page(width=595, height=842)
+            writers = new_text_writers(page)
             y = 50
             # Reinsertar encabezados en nueva página
-            page.insert_text((50, y), headers[0], fontsize=12, fontname="helv")
-            page.insert_text((200, y), headers[1], fontsize=12, fontname="helv")
-            page.insert_text((450, y), headers[2], fontsize=12, fontname="helv") # Reinsertar SH
+            continuation_header.write_text(page, color=TEXT_COLOR)
             y += 20
 
-        page.insert_text((50, y), row["Código"], fontsize=10)
+        writers[TEXT_COLOR].append((50, y), row["Código"], font=HELV_FONT, fontsize=10)
 
         # Descripción en múltiples líneas si es necesario
         desc = row["Descripción"]
         if len(desc) > 50: # Ajustar el límite de caracteres para la descripción
-            page.insert_text((200, y), desc[:50], fontsize=9)
-            page.insert_text((200, y + 12), desc[50:], fontsize=9)
+            writers[TEXT_COLOR].append((200, y), desc[:50], font=HELV_FONT, fontsize=9)
+            writers[TEXT_COLOR].append((200, y + 12), desc[50:], font=HELV_FONT, fontsize=9)
             y_offset_for_next_line = 12
         else:
-            page.insert_text((200, y), desc, fontsize=10)
+            writers[TEXT_COLOR].append((200, y), desc, font=HELV_FONT, fontsize=10)
             y_offset_for_next_line = 0
 
         # Agregar el SH
-        page.insert_text((450, y), row["SH"], fontsize=10) # Posición para el SH
+        writers[TEXT_COLOR].append((450, y), row["SH"], font=HELV_FONT, fontsize=10) # Posición para el SH
 
         y += 15 + y_offset_for_next_line # Espacio entre filas, considerando la descripción multilinea
 
+    flush_text_writers(page, writers)
     return doc
 
-def create_gloves_table(relations):
+def create_gloves_table(gloves_data, target_doc=None):
     """
-    Crea una tabla PDF solo para guantes (códigos que empiezan con G4-).
+    Crea una tabla PDF solo para guantes (relaciones de la categoría "Guantes", códigos G4-),
+    ya ordenadas por código.
     """
-    gloves_data = [
-        rel for rel in relations
-        if rel["Código"].startswith("G4-")
-    ]
-
     if not gloves_data:
         return None
 
@@ -782,44 +649,44 @@ def create_gloves_table(relations):
                 "SH": rel["SH"]
             }
 
-    doc = fitz.open()
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page(width=595, height=842)
+    writers = new_text_writers(page)
     y = 50
 
     # Título
-    page.insert_text((50, y), "LISTADO DE GUANTES", fontsize=16, color=(0, 0, 1))
+    writers[TITLE_COLOR].append((50, y), "LISTADO DE GUANTES", font=HELV_FONT, fontsize=16)
     y += 30
 
-    headers = ["Código", "Descripción", "SH"]
-    page.insert_text((50, y), headers[0], fontsize=12)
-    page.insert_text((200, y), headers[1], fontsize=12)
-    page.insert_text((450, y), headers[2], fontsize=12)
+    table_header_writer(LISTING_COLUMNS, y).write_text(page, color=TEXT_COLOR)
     y += 20
+    continuation_header = table_header_writer(LISTING_COLUMNS, 50)
 
-    df = pd.DataFrame(unique_gloves.values()).sort_values(by="Código")
+    rows = list(unique_gloves.values())
 
-    for _, row in df.iterrows():
+    for row in rows:
         if y > 750:
+            flush_text_writers(page, writers)
             page = doc.new_page(width=595, height=842)
+            writers = new_text_writers(page)
             y = 50
             # Reinsertar encabezados
-            page.insert_text((50, y), headers[0], fontsize=12)
-            page.insert_text((200, y), headers[1], fontsize=12)
-            page.insert_text((450, y), headers[2], fontsize=12)
+            continuation_header.write_text(page, color=TEXT_COLOR)
             y += 20
 
-        page.insert_text((50, y), row["Código"], fontsize=10)
+        writers[TEXT_COLOR].append((50, y), row["Código"], font=HELV_FONT, fontsize=10)
         desc = row["Descripción"]
         if len(desc) > 50:
-            page.insert_text((200, y), desc[:50], fontsize=9)
-            page.insert_text((200, y + 12), desc[50:], fontsize=9)
+            writers[TEXT_COLOR].append((200, y), desc[:50], font=HELV_FONT, fontsize=9)
+            writers[TEXT_COLOR].append((200, y + 12), desc[50:], font=HELV_FONT, fontsize=9)
             y += 12
         else:
-            page.insert_text((200, y), desc, fontsize=10)
+            writers[TEXT_COLOR].append((200, y), desc, font=HELV_FONT, fontsize=10)
 
-        page.insert_text((450, y), row["SH"], fontsize=10)
+        writers[TEXT_COLOR].append((450, y), row["SH"], font=HELV_FONT, fontsize=10)
         y += 15
 
+    flush_text_writers(page, writers)
     return doc
 
 def show_shipping_summary(order_meta):
@@ -875,7 +742,7 @@ def show_shipping_summary(order_meta):
         ("OVERNIGHT", ["OVERNIGHT"]),
     ]
     
-    # Crear DataFrame para mostrar en Streamlit
+    # Crear tabla para mostrar en Streamlit
     data = []
     for group_name, methods in grouped_methods:
         total = sum(shipping_counts.get(method, 0) for method in methods)
@@ -883,8 +750,7 @@ def show_shipping_summary(order_meta):
             data.append({"Grupo de Métodos": group_name, "Cantidad": total})
     
     if data:
-        df = pd.DataFrame(data)
-        st.dataframe(df)
+        st.dataframe(pa.Table.from_pylist(data))
     else:
         st.warning("No se encontraron métodos de envío registrados.")
 
@@ -892,10 +758,8 @@ def show_shipping_summary(order_meta):
 
 
 
-def create_shipping_methods_summary(order_meta):
+def create_shipping_methods_summary(order_meta, target_doc=None):
     """Crea un resumen completo de los métodos de envío y su frecuencia para PDF"""
-    doc = fitz.open()
-    
     shipping_methods = [
         "GU 9", "PICKUP", "PO BOX",
         "AK 9", "NO SHIPMENT", "GENERAL DELIVERY",
@@ -909,7 +773,7 @@ def create_shipping_methods_summary(order_meta):
     shipping_counts = {method: 0 for method in shipping_methods}
     
     if not isinstance(order_meta, dict):
-        return doc
+        return None
     
     # Contar frecuencias
     for oid, meta in order_meta.items():
@@ -930,9 +794,10 @@ def create_shipping_methods_summary(order_meta):
     shipping_counts = {k: v for k, v in shipping_counts.items() if v > 0}
     
     if not shipping_counts:
-        return doc
+        return None
     
     # Crear página con la tabla
+    doc = target_doc if target_doc is not None else fitz.open()
     page = doc.new_page()
     
     # Título principal
@@ -985,7 +850,23 @@ def create_shipping_methods_summary(order_meta):
     
     return doc
 
-def merge_documents(build_order, build_map, ship_map, order_meta, pickup_flag, all_relations, all_two_day):
+def page_runs(page_numbers):
+    """Agrupa números de página consecutivos en rangos (inicio, fin), respetando el orden."""
+    runs = []
+    for number in page_numbers:
+        if runs and runs[-1][1] + 1 == number:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return runs
+
+
+def merge_documents(build_order, build_map, ship_map, order_meta, pickup_flag, relations_by_category, all_two_day,
+                    build_doc, ship_doc):
+    """
+    Arma el PDF consolidado. `build_doc` y `ship_doc` son los PDFs originales
+    de donde se copian las páginas de cada orden.
+    """
     doc = fitz.open()
     
     # Verificar y procesar pickups
@@ -995,98 +876,69 @@ def merge_documents(build_order, build_map, ship_map, order_meta, pickup_flag, a
                  isinstance(order_meta.get(oid, {}), dict) and 
                  order_meta[oid].get("pickup", False)]
     
+    # Las tablas y resúmenes se dibujan directamente en `doc`, sin documentos intermedios.
+    def insert_section(label, render):
+        # El divisor va delante de su sección; se inserta en esa posición
+        # solo si la sección dibujó alguna página.
+        section_start = doc.page_count
+        if render():
+            insert_divider_page(doc, label, pno=section_start)
+
     # 1. Insertar tabla de relaciones
-    if all_relations:
-        relations_table = create_relations_table(all_relations)
-        if relations_table:
-            doc.insert_pdf(relations_table)
-            insert_divider_page(doc, "Resumen de Apariciones por Categoría")
-
-    # 2. Resumen de Apariciones: Bolsas
-    summary_bags = create_part_numbers_summary(order_meta, category_filter="Otros")
-    if summary_bags:
-        doc.insert_pdf(summary_bags)
-
-    # 3. Resumen de Apariciones: Pelotas
-    summary_balls = create_part_numbers_summary(order_meta, category_filter="Pelotas")
-    if summary_balls:
-        doc.insert_pdf(summary_balls)
-
-    # 4. Resumen de Apariciones: Gorras
-    summary_hats = create_part_numbers_summary(order_meta, category_filter="Gorras")
-    if summary_hats:
-        doc.insert_pdf(summary_hats)
-
-    # 5. Resumen de Apariciones: Accesorios
-    # CORRECCIÓN: Usar order_meta en lugar de all_relations
-    summary_accessories = create_part_numbers_summary(order_meta, category_filter="Accesorios")
-    if summary_accessories:
-        doc.insert_pdf(summary_accessories)
-    
-    # 5.5 Resumen de Apariciones: Guantes
-    # CORRECCIÓN: Usar order_meta en lugar de all_relations
-    summary_gloves = create_part_numbers_summary(order_meta, category_filter="Guantes")
-    if summary_gloves:
-        doc.insert_pdf(summary_gloves)
-        insert_divider_page(doc, "Listado de Pelotas por Relación")
-
-     # NUEVA SECCIÓN: Resumen de métodos de envío
-    if isinstance(order_meta, dict):
-        shipping_summary = create_shipping_methods_summary(order_meta)
-        if shipping_summary.page_count > 0:  # Verificar que tiene páginas
-            doc.insert_pdf(shipping_summary)
-            insert_divider_page(doc, "Órdenes con Shipping Method: 2 Day")
+    if any(relations_by_category.values()):
+        create_relations_table(relations_by_category["Otros"], target_doc=doc)
+
+    # Las apariciones de todas las categorías se agregan una sola vez
+    appearances_by_category = summarize_part_appearances(order_meta)
+
+    def render_part_summaries():
+        # 2-5.5. Bolsas, Pelotas, Gorras, Accesorios y Guantes.
+        # Las categorías sin apariciones se saltan sin llamar al renderizador.
+        categories = [category for category in ("Otros", "Pelotas", "Gorras", "Accesorios", "Guantes")
+                      if appearances_by_category.get(category)]
+        for category in categories:
+            create_part_numbers_summary(appearances_by_category[category], category_filter=category, target_doc=doc)
+        return bool(categories)
+
+    insert_section("Resumen de Apariciones por Categoría", render_part_summaries)
+
+    # NUEVA SECCIÓN: Resumen de métodos de envío
+    insert_section("Resumen de Métodos de Envío",
+                   lambda: create_shipping_methods_summary(order_meta, target_doc=doc))
 
     # 6. Insertar página de SH 2 day
-    two_day_page = create_2day_shipping_page(all_two_day)
-    if two_day_page:
-        doc.insert_pdf(two_day_page)
-        insert_divider_page(doc, "Listado de Pelotas por Relación")
-
-    # 7. Insertar página de Pelotas (listado de relaciones)
-    pelotas_doc = create_category_table(all_relations, "Pelotas")
-    if pelotas_doc:
-        doc.insert_pdf(pelotas_doc)
-        insert_divider_page(doc, "Listado de Gorras por Relación")
-
-    # 8. Insertar página de Gorras (listado de relaciones)
-    gorras_doc = create_category_table(all_relations, "Gorras")
-    if gorras_doc:
-        doc.insert_pdf(gorras_doc)
-        insert_divider_page(doc, "Listado de Accesorios por Relación")
-
-    # 8.5 Insertar página de Guantes (listado de relaciones)
-    gloves_doc = create_gloves_table(all_relations)
-    if gloves_doc:
-        doc.insert_pdf(gloves_doc)
-        insert_divider_page(doc, "Listado de Accesorios por Relación")
-
-    # 9. Insertar página de Accesorios (listado de relaciones)
-    accesorios_doc = create_category_table(all_relations, "Accesorios")
-    if accesorios_doc:
-        doc.insert_pdf(accesorios_doc)
+    insert_section("Órdenes con Shipping Method: 2 Day",
+                   lambda: create_2day_shipping_page(all_two_day, target_doc=doc))
+
+    # 7-9. Listados de Pelotas, Gorras, Guantes y Accesorios (por relación)
+    insert_section("Listado de Pelotas por Relación",
+                   lambda: create_category_table(relations_by_category["Pelotas"], "Pelotas", target_doc=doc))
+    insert_section("Listado de Gorras por Relación",
+                   lambda: create_category_table(relations_by_category["Gorras"], "Gorras", target_doc=doc))
+    insert_section("Listado de Guantes por Relación",
+                   lambda: create_gloves_table(relations_by_category["Guantes"], target_doc=doc))
+    insert_section("Listado de Accesorios por Relación",
+                   lambda: create_category_table(relations_by_category["Accesorios"], "Accesorios", target_doc=doc))
+
+    if build_order:
         insert_divider_page(doc, "Documentos Principales")
 
     # Insertar páginas de órdenes
+    def insert_page_runs(source_doc, pages, oid, label):
+        # Las páginas consecutivas del mismo PDF se copian con un solo insert_pdf.
+        # final=False conserva el mapa de objetos ya copiados de cada PDF original,
+        # así fuentes e imágenes compartidas no se vuelven a copiar en cada inserción.
+        page_numbers = [p["number"] for p in pages if isinstance(p, dict) and "number" in p]
+        for from_page, to_page in page_runs(page_numbers):
+            try:
+                doc.insert_pdf(source_doc, from_page=from_page, to_page=to_page, final=False)
+            except Exception as e:
+                print(f"Error insertando {label} pages para orden {oid}: {str(e)}")
+
     def insert_order_pages(order_list):
         for oid in order_list:
-            # Insertar build pages con manejo seguro
-            build_pages = build_map.get(oid, {}).get("pages", [])
-            for p in build_pages:
-                if isinstance(p, dict) and "parent" in p and "number" in p:
-                    try:
-                        doc.insert_pdf(p["parent"], from_page=p["number"], to_page=p["number"])
-                    except Exception as e:
-                        print(f"Error insertando build page para orden {oid}: {str(e)}")
-
-            # Insertar ship pages con manejo seguro
-            ship_pages = ship_map.get(oid, {}).get("pages", [])
-            for p in ship_pages:
-                if isinstance(p, dict) and "parent" in p and "number" in p:
-                    try:
-                        doc.insert_pdf(p["parent"], from_page=p["number"], to_page=p["number"])
-                    except Exception as e:
-                        print(f"Error insertando ship page para orden {oid}: {str(e)}")
+            insert_page_runs(build_doc, build_map.get(oid, {}).get("pages", []), oid, "build")
+            insert_page_runs(ship_doc, ship_map.get(oid, {}).get("pages", []), oid, "ship")
 
     # Insertar pickups primero si está habilitado
     if pickup_flag and pickups:
@@ -1102,6 +954,44 @@ def merge_documents(build_order, build_map, ship_map, order_meta, pickup_flag, a
     return doc
 
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_merged_pdf(build_bytes, ship_bytes, pickup_flag):
+    """
+    Genera el PDF consolidado a partir de los dos PDFs subidos y devuelve sus bytes.
+    Los resultados de parse_pdf también están en caché, así que rehacer los
+    agrupamientos aquí no vuelve a leer los documentos.
+    """
+    build_pages, build_relations, build_two_day = parse_pdf(build_bytes)
+    ship_pages, ship_relations, ship_two_day = parse_pdf(ship_bytes)
+
+    all_relations = unique_relations(build_relations + ship_relations)
+    all_two_day = sorted(build_two_day.union(ship_two_day))
+    all_meta = group_by_order(build_pages + ship_pages, classify_pickup=pickup_flag)
+    # Se ordena una sola vez por código; el orden es estable, así que cada código conserva
+    # su primer SH. Cada categoría hereda este orden y las tablas del PDF no reordenan.
+    relations_by_category = group_relations_by_category(sorted(all_relations, key=lambda rel: rel["Código"]))
+
+    build_map = group_by_order(build_pages)
+    ship_map = group_by_order(ship_pages)
+    build_order = get_build_order_list(build_pages)
+
+    # Los PDFs originales se abren solo aquí: parse_pdf (en caché) no guarda documentos.
+    # Se cierran en cuanto sus páginas están copiadas en el consolidado.
+    with fitz.open(stream=build_bytes, filetype="pdf") as build_doc, \
+            fitz.open(stream=ship_bytes, filetype="pdf") as ship_doc:
+        merged = merge_documents(build_order, build_map, ship_map, all_meta, pickup_flag, relations_by_category,
+                                 all_two_day, build_doc, ship_doc)
+
+    # Insertar resumen al inicio, dibujado directamente en el consolidado
+    create_summary_page(all_meta, build_map.keys(), ship_map.keys(), pickup_flag, target_doc=merged, pno=0)
+
+    # garbage=4 elimina objetos duplicados entre los PDFs combinados y deflate comprime los streams
+    output = io.BytesIO()
+    merged.save(output, garbage=4, deflate=True)
+    merged.close()
+    return output.getvalue()
+
+
 # === Interfaz de Streamlit ===
 st.title("Tequila Build/Shipment PDF Processor")
 
@@ -1110,8 +1000,9 @@ ship_file = st.file_uploader("Upload Shipment Pick Lists PDF", type="pdf")
 pickup_flag = st.checkbox("Summarize Customer Pickup orders", value=True)
 
 if build_file and ship_file:
-    build_bytes = build_file.read()
-    ship_bytes = ship_file.read()
+    # getvalue() devuelve el buffer del archivo subido sin copiarlo de nuevo
+    build_bytes = build_file.getvalue()
+    ship_bytes = ship_file.getvalue()
 
     # Procesar ambos PDFs
     build_pages, build_relations, build_two_day = parse_pdf(build_bytes)
@@ -1119,8 +1010,9 @@ if build_file and ship_file:
 
     # Combinar todo
     original_pages = build_pages + ship_pages
-    all_relations = build_relations + ship_relations
-    all_two_day = build_two_day.union(ship_two_day)
+    all_relations = unique_relations(build_relations + ship_relations)
+    # Se ordena una sola vez; la tabla en pantalla y la página PDF usan esta lista
+    all_two_day = sorted(build_two_day.union(ship_two_day))
     all_meta = group_by_order(original_pages, classify_pickup=pickup_flag)
 
     st.subheader("Tablas Interactivas de Datos")
@@ -1129,17 +1021,18 @@ if build_file and ship_file:
     display_interactive_table(all_relations)
 
     # Mostrar tablas interactivas por categoría
-    display_category_table(all_relations, "Pelotas")
-    display_category_table(all_relations, "Gorras")
-    display_category_table(all_relations, "Guantes")
-    display_category_table(all_relations, "Accesorios")
+    relations_by_category = group_relations_by_category(all_relations)
+    display_category_table(relations_by_category["Pelotas"], "Pelotas")
+    display_category_table(relations_by_category["Gorras"], "Gorras")
+    display_category_table(relations_by_category["Guantes"], "Guantes")
+    display_category_table(relations_by_category["Accesorios"], "Accesorios")
 
     st.subheader("Resumen de Órdenes y Envíos")
 
     # Mostrar SH con método 2 day
     if all_two_day:
         st.subheader("Órdenes con Shipping Method: 2 day")
-        st.write(", ".join(sorted(all_two_day)))
+        st.write(", ".join(all_two_day))
     else:
         st.warning("No se encontraron órdenes con Shipping Method: 2 day")
 
@@ -1149,25 +1042,17 @@ if build_file and ship_file:
     # =================================
 
     # Botón para generar y descargar el PDF consolidado
-    if st.button("Generate Merged Output"):
-        # Asegúrate de que estas variables se calculen correctamente
-        # antes de pasarlas a merge_documents
-        build_map = group_by_order(build_pages)
-        ship_map = group_by_order(ship_pages)
-        build_order = get_build_order_list(build_pages)
-
-        # Generar resúmenes
-        summary = create_summary_page(all_meta, build_map.keys(), ship_map.keys(), pickup_flag)
-        merged = merge_documents(build_order, build_map, ship_map, all_meta, pickup_flag, all_relations, all_two_day)
-
-        # Insertar resumen al inicio
-        if summary:
-            merged.insert_pdf(summary, start_at=0)
+    # Sin órdenes no hay nada que combinar: no se ofrece generar un PDF vacío.
+    if not all_meta:
+        st.warning("No se encontraron órdenes en los PDFs subidos; no hay nada que combinar.")
+    elif st.button("Generate Merged Output"):
+        # El PDF queda en caché por archivos y opción de pickups: repetir la generación es inmediato
+        merged_bytes = build_merged_pdf(build_bytes, ship_bytes, pickup_flag)
 
         # Botón de descarga
         st.download_button(
             "Download Merged Output PDF",
-            data=merged.tobytes(),
+            data=merged_bytes,
             file_name="Tequila_Merged_Output.pdf"
         )
 elif build_file or ship_file: